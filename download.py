@@ -34,13 +34,23 @@ import json
 import logging
 import os.path
 import re
-import shutil
 import socket
+import threading
+import time
 from shared import validate_settings
 from shared import get_config_values
 from shared import get_settings
 from shared import get_command_line_arguments
 from shared import configure_logging
+from shared import get_leased_generations
+from shared import get_snapshot_path
+from shared import load_library_pointer
+from shared import load_library_snapshot
+from shared import replace_file
+from shared import write_json_atomically
+from scheduler import BandwidthLimiter
+from scheduler import EncodeJob
+from scheduler import EncodeScheduler
 
 try:
     # For Python 3.0 and later
@@ -60,6 +70,11 @@ except ImportError:
     from urllib2 import URLError
 
 
+# Guards read-modify-write updates of the list file, which happen on both
+# the main thread and the encode scheduler thread
+list_file_lock = threading.Lock()
+
+
 def get_trailer_file_urls(page_url, res, types):
     # Get trailer file URLs
     urls = []
@@ -139,48 +154,133 @@ def get_downloaded_files(dl_list_path):
 
 def write_downloaded_files(file_list, dl_list_path):
     # Write list of downloaded files to text file
+    # Swap the file into place to keep readers from seeing a partial list
     new_list = [filename + u'\n' for filename in file_list]
-    downloads_file = io.open(dl_list_path, mode='w', encoding='utf-8')
+    temp_path = "{}.{}.{}.tmp".format(dl_list_path, os.getpid(), threading.current_thread().ident)
+    downloads_file = io.open(temp_path, mode='w', encoding='utf-8')
     downloads_file.writelines(new_list)
     downloads_file.close()
+    replace_file(temp_path, dl_list_path)
 
 
 def record_downloaded_file(filename, dl_list_path):
     # Append downloaded filename to the text file
-    file_list = get_downloaded_files(dl_list_path)
-    file_list.append(filename)
-    write_downloaded_files(file_list, dl_list_path)
-
-
-def create_json_file(list_file, download_dir, json_file):
-    # Create json file of downloaded trailers
-    downloaded_trailers = get_downloaded_files(list_file)
-    trailers={}
-    i = 1
-    for item in downloaded_trailers:
-        trailers[i] = download_dir+"/"+item
-        i = i + 1
-    with open(json_file, 'w') as f:
-        json.dump(trailers, f)
-    f.close
-
-
-def delete_old_trailers(trailers, list_file, download_dir):
-    downloaded_files = get_downloaded_files(list_file)
-    for item in downloaded_files:
-        if item not in trailers:
-            logging.debug("*** File no longer necessary. Deleting "+item)
-            os.remove(download_dir+'/'+item)
-    write_downloaded_files(trailers, list_file)
-
-
-def download_trailer_file(url, destdir, filename):
-    # Download the trailer file from the URL
+    with list_file_lock:
+        file_list = get_downloaded_files(dl_list_path)
+        file_list.append(filename)
+        write_downloaded_files(file_list, dl_list_path)
+
+
+def publish_library_snapshot(list_file, download_dir, json_file):
+    # Write an immutable snapshot of downloaded trailers for mix.py and
+    # atomically point the json file at it
+    generation = 0
+    if os.path.exists(json_file):
+        generation, current_path = load_library_pointer(json_file)
+        if current_path == json_file:
+            # Keep the pre-snapshot library as generation 0 so mixes that
+            # are still reading it keep their files until they finish
+            legacy_trailers = load_library_snapshot(json_file)
+            write_json_atomically({'generation': 0, 'trailers': legacy_trailers}, get_snapshot_path(json_file, 0))
+    generation = generation + 1
+
+    trailers = [download_dir+"/"+item for item in get_downloaded_files(list_file)]
+    snapshot_path = get_snapshot_path(json_file, generation)
+    write_json_atomically({'generation': generation, 'trailers': trailers}, snapshot_path)
+    write_json_atomically({'generation': generation, 'snapshot': snapshot_path}, json_file)
+    logging.debug("Published library generation %s", generation)
+    return generation
+
+
+def get_library_snapshots(json_file):
+    # Map generation numbers to snapshot paths found next to the json file
+    snapshots = {}
+    json_dir = os.path.dirname(json_file)
+    prefix = os.path.basename(json_file) + '.'
+    for name in os.listdir(json_dir):
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and suffix.isdigit():
+            snapshots[int(suffix)] = os.path.join(json_dir, name)
+    return snapshots
+
+
+def retire_old_trailers(trailers, list_file):
+    # Drop trailers that are no longer needed from the list file and return them
+    # Trailers that were not fully downloaded and converted stay off the list
+    with list_file_lock:
+        downloaded_files = get_downloaded_files(list_file)
+        retired = [item for item in downloaded_files if item not in trailers]
+        write_downloaded_files([item for item in trailers if item in downloaded_files], list_file)
+    return retired
+
+
+def delete_abandoned_downloads(trailers, download_dir):
+    # Delete partial downloads of trailers that are no longer in the feed
+    prefix = get_partial_file_name('')
+    for name in os.listdir(download_dir):
+        if name.startswith(prefix) and name[len(prefix):] not in trailers:
+            logging.debug("*** Partial download no longer necessary. Deleting "+name)
+            os.remove(os.path.join(download_dir, name))
+
+
+def delete_old_generations(json_file, generation, download_dir, retired):
+    # Delete snapshots and trailer files that no running mix can still read
+    leased = get_leased_generations(json_file, time.time())
+    if leased is None:
+        logging.debug("*** A mix is starting, keeping old trailers until the next run")
+        return
+    keep = leased | set([generation])
+
+    snapshots = get_library_snapshots(json_file)
+    in_use = set()
+    unused = set(download_dir+'/'+item for item in retired)
+    for snapshot_generation in snapshots:
+        trailers = load_library_snapshot(snapshots[snapshot_generation])
+        if snapshot_generation in keep:
+            in_use.update(trailers)
+        else:
+            unused.update(trailers)
+
+    for path in sorted(unused - in_use):
+        if os.path.exists(path):
+            logging.debug("*** File no longer necessary. Deleting "+path)
+            os.remove(path)
+
+    for snapshot_generation in snapshots:
+        if snapshot_generation not in keep:
+            os.remove(snapshots[snapshot_generation])
+
+
+def copy_with_limits(server_file_handle, local_file_handle, chunk_size, limiter):
+    # Copy the download through the shared rate limiter
+    # Returns False if the download window closed before the copy finished
+    while True:
+        if not limiter.in_window():
+            return False
+        chunk = server_file_handle.read(limiter.get_chunk_size(chunk_size))
+        if not chunk:
+            return True
+        limiter.consume(len(chunk))
+        local_file_handle.write(chunk)
+
+
+def get_partial_file_name(filename):
+    # Name a trailer is downloaded under until it has been converted
+    return '.part.' + filename
+
+
+def download_trailer_file(url, destdir, filename, limiter):
+    # Download the trailer file from the URL into its partial file
     # Spoof the user agent
     # Resume partial downloads and skip already downloaded files
-    file_path = os.path.join(destdir, filename)
+    # Returns True once the whole file is on disk
+    file_path = os.path.join(destdir, get_partial_file_name(filename))
     file_exists = os.path.exists(file_path)
 
+    if not limiter.in_window():
+        logging.info("*** Outside download hours, deferring to the next run")
+        return False
+
     existing_file_size = 0
     if file_exists:
         existing_file_size = os.path.getsize(file_path)
@@ -200,16 +300,20 @@ def download_trailer_file(url, destdir, filename):
     except HTTPError as ex:
         if ex.code == 416:
             logging.debug("*** File already downloaded, skipping")
-            return
+            return True
         elif ex.code == 404:
             logging.error("*** Error downloading file: file not found")
-            return
+            return False
 
         logging.error("*** Error downloading file")
-        return
+        return False
     except URLError as ex:
         logging.error("*** Error downloading file")
-        return
+        return False
+
+    if resume_download and server_file_handle.getcode() != 206:
+        logging.debug("  Server ignored the resume request, starting over")
+        resume_download = False
 
     chunk_size = 1024 * 1024
 
@@ -217,18 +321,23 @@ def download_trailer_file(url, destdir, filename):
         if resume_download:
             logging.debug("  Resuming file %s", file_path)
             with open(file_path, 'ab') as local_file_handle:
-                shutil.copyfileobj(server_file_handle, local_file_handle, chunk_size)
+                complete = copy_with_limits(server_file_handle, local_file_handle, chunk_size, limiter)
         else:
             logging.debug("  Saving file to %s", file_path)
             with open(file_path, 'wb') as local_file_handle:
-                shutil.copyfileobj(server_file_handle, local_file_handle, chunk_size)
+                complete = copy_with_limits(server_file_handle, local_file_handle, chunk_size, limiter)
     except socket.error as ex:
         logging.error("*** Network error while downloading file: %s", ex)
-        return
+        return False
 
+    if not complete:
+        logging.info("*** Download hours ended, will resume %s on the next run", filename)
+    return complete
 
-def convert(trailer_file_name, destdir, res, ffmpeg_path):
-    # Convert video resolution and use x264 at 24fps and aac
+
+def convert(trailer_file_name, destdir, res, encoder, dl_list_path):
+    # Queue conversion to x264 at 24fps and aac at the target resolution
+    # The file is recorded as downloaded once the encode has finished
     if res == '480':
         target_width = '848'
         target_height = '480'
@@ -239,14 +348,36 @@ def convert(trailer_file_name, destdir, res, ffmpeg_path):
         target_width = '1920'
         target_height = '1080'
 
-    logging.debug("  Converting")
-    os.system(ffmpeg_path+' -loglevel panic -i "'+destdir+'/'+trailer_file_name+'" -vf "scale='+target_width+':'+target_height+':force_original_aspect_ratio=decrease,pad='+target_width+':'+target_height+':(ow-iw)/2:(oh-ih)/2" -c:v libx264 -c:a aac -r 24 "'+destdir+'/.output.mov"')
-    os.remove(destdir+'/'+trailer_file_name)
-    os.rename(destdir+'/.output.mov', destdir+'/'+trailer_file_name)
-
-
-def download_trailers_from_page(page_url, dl_list_path, res, destdir, types, ffmpeg_path):
+    partial_path = destdir+'/'+get_partial_file_name(trailer_file_name)
+    file_path = destdir+'/'+trailer_file_name
+    output_path = destdir+'/.output.'+trailer_file_name
+
+    def finish():
+        # The trailer only appears under its real name once converted
+        replace_file(output_path, file_path)
+        os.remove(partial_path)
+        record_downloaded_file(trailer_file_name, dl_list_path)
+        logging.debug("  Converted %s", trailer_file_name)
+
+    def discard():
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+    logging.debug("  Queueing conversion")
+    encoder.submit(EncodeJob(
+        ['-loglevel', 'panic', '-y', '-i', partial_path,
+         '-vf', 'scale='+target_width+':'+target_height+':force_original_aspect_ratio=decrease,pad='+target_width+':'+target_height+':(ow-iw)/2:(oh-ih)/2',
+         '-c:v', 'libx264', '-c:a', 'aac', '-r', '24'],
+        output_path,
+        on_success=finish,
+        on_failure=discard
+    ))
+
+
+def download_trailers_from_page(page_url, dl_list_path, res, destdir, types, encoder, limiter):
     # Downloads trailer from page URL
+    if not limiter.in_window():
+        return None
     logging.debug('Checking for files at ' + page_url)
     trailer_urls = get_trailer_file_urls(page_url, res, types)
     downloaded_files = get_downloaded_files(dl_list_path)
@@ -255,11 +386,17 @@ def download_trailers_from_page(page_url, dl_list_path, res, destdir, types, ffm
         trailer_file_name = get_trailer_filename(trailer_url['title'], trailer_url['type'], trailer_url['res'])
         trailer_file_name = removeNonAscii(trailer_file_name)
 
-        if trailer_file_name not in downloaded_files:
-            logging.info('Downloading ' + trailer_url['type'] + ': ' + trailer_file_name)
-            download_trailer_file(trailer_url['url'], destdir, trailer_file_name)
-            convert(trailer_file_name, destdir, res, ffmpeg_path)
+        if trailer_file_name not in downloaded_files and os.path.exists(os.path.join(destdir, trailer_file_name)):
+            # A retired trailer that is back in the feed and still on disk
+            # has already been converted
+            logging.debug('*** Reusing converted file: ' + trailer_file_name)
             record_downloaded_file(trailer_file_name, dl_list_path)
+        elif trailer_file_name not in downloaded_files:
+            logging.info('Downloading ' + trailer_url['type'] + ': ' + trailer_file_name)
+            if not download_trailer_file(trailer_url['url'], destdir, trailer_file_name, limiter):
+                # Partial files are kept and resumed on the next run
+                return None
+            convert(trailer_file_name, destdir, res, encoder, dl_list_path)
         else:
             logging.debug('*** File already downloaded, skipping: ' + trailer_file_name)
 
@@ -311,6 +448,22 @@ def main():
 
     logging.debug("")
 
+    # Encodes run in the background on spare CPU while downloads continue
+    encoder = EncodeScheduler(
+        settings['ffmpeg_path'],
+        max_encodes=int(settings['max_encodes']),
+        cpu_limit=float(settings['encode_cpu_limit']),
+        nice=int(settings['encode_nice']),
+        sessions_url=settings['plex_sessions_url'],
+        max_hold=int(settings['encode_max_hold']) * 60
+    )
+
+    # All downloads share one bandwidth limit and download window
+    limiter = BandwidthLimiter(settings['download_rate_limit'], settings['download_hours'])
+    if not limiter.in_window():
+        logging.info("Outside download hours, nothing to do")
+        return
+
     # Do the download
     if 'page' in settings:
         # The trailer page URL was passed in on the command line
@@ -320,8 +473,10 @@ def main():
             settings['resolution'],
             settings['download_dir'],
             settings['video_types'],
-            settings['ffmpeg_path']
+            encoder,
+            limiter
         )
+        encoder.wait()
 
     else:
         # Get trailers from feed
@@ -329,10 +484,14 @@ def main():
         get_trailers = load_json_from_url(feed_url)
         trailers = []
         count = 0
+        window_closed = False
 
         # Box office trailers
         box_office_trailers = get_trailers['items'][1]['thumbnails']
         for trailer in box_office_trailers:
+            if not limiter.in_window():
+                window_closed = True
+                break
             url = 'http://trailers.apple.com' + trailer['url']
             download = download_trailers_from_page(
                 url,
@@ -340,7 +499,8 @@ def main():
                 settings['resolution'],
                 settings['download_dir'],
                 settings['video_types'],
-                settings['ffmpeg_path']
+                encoder,
+                limiter
             )
             if download:
                 trailers.append(download)
@@ -352,6 +512,9 @@ def main():
         # Most popular trailers
         most_popular_trailers = get_trailers['items'][0]['thumbnails']
         for trailer in most_popular_trailers:
+            if window_closed or not limiter.in_window():
+                window_closed = True
+                break
             url = 'http://trailers.apple.com' + trailer['url']
             download = download_trailers_from_page(
                 url,
@@ -359,7 +522,8 @@ def main():
                 settings['resolution'],
                 settings['download_dir'],
                 settings['video_types'],
-                settings['ffmpeg_path']
+                encoder,
+                limiter
             )
             if download:
                 trailers.append(download)
@@ -367,11 +531,24 @@ def main():
             if count >= (int(settings['max_trailers'])):
                 break
 
-        # Delete old trailers
-        delete_old_trailers(trailers, settings['list_file'], settings['download_dir'])
+        # Wait for queued conversions to be recorded
+        encoder.wait()
+
+        # Retire old trailers from the list, but keep the files for now
+        # If the download window closed part way, the feed was not fully
+        # checked, so keep every trailer until a run that finishes
+        retired = []
+        if window_closed:
+            logging.info("*** Download hours ended, stopping until the next run")
+        else:
+            retired = retire_old_trailers(trailers, settings['list_file'])
+            delete_abandoned_downloads(trailers, settings['download_dir'])
+
+        # Publish a new library generation for mix.py
+        generation = publish_library_snapshot(settings['list_file'], settings['download_dir'], settings['json_file'])
 
-        # Create json file of downloaded trailers for mix.py
-        create_json_file(settings['list_file'], settings['download_dir'], settings['json_file'])
+        # Delete files that no running mix can still reference
+        delete_old_generations(settings['json_file'], generation, settings['download_dir'], retired)
 
 
 # Run the script
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+# Use this script to measure how quickly mix.py turns a playback start
+# into a playable pre-roll video. It builds a synthetic trailer library
+# with ffmpeg's testsrc, then replays trigger patterns against mix.py the
+# same way Tautulli would (one process per playback start) and reports
+# trigger-to-ready latency, overlapping runs, CPU time and bytes written.
+#
+# You must have ffmpeg installed in order to use this. Please see
+# <https://github.com/FFmpeg/FFmpeg>.
+#
+# Example: five households starting streams at once, three times
+#   python loadtest.py --pattern burst --burst-size 5 --bursts 3
+
+# Copyright 2018 David Engel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import io
+import logging
+import os
+import os.path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from download import publish_library_snapshot
+from download import write_downloaded_files
+from shared import configure_logging
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def get_command_line_arguments():
+    # Parse load test options
+
+    parser = argparse.ArgumentParser(
+        description='Replay playback-start triggers against mix.py using a ' +
+        'synthetic trailer library and report trigger-to-ready latency.'
+    )
+
+    parser.add_argument('--ffmpeg', default='ffmpeg',
+                        help='The path to ffmpeg. Defaults to "ffmpeg" on the PATH.')
+    parser.add_argument('--pattern', choices=['poisson', 'burst'], default='poisson',
+                        help='How triggers arrive. Defaults to "poisson".')
+    parser.add_argument('--triggers', type=int, default=20,
+                        help='Number of triggers for the poisson pattern. Defaults to 20.')
+    parser.add_argument('--rate', type=float, default=0.5,
+                        help='Mean poisson arrivals per second. Defaults to 0.5.')
+    parser.add_argument('--burst-size', type=int, default=4,
+                        help='Triggers fired at once in each burst. Defaults to 4.')
+    parser.add_argument('--bursts', type=int, default=3,
+                        help='Number of bursts. Defaults to 3.')
+    parser.add_argument('--interval', type=float, default=10.0,
+                        help='Seconds between bursts. Defaults to 10.')
+    parser.add_argument('--library-size', type=int, default=10,
+                        help='Number of synthetic trailers. Defaults to 10.')
+    parser.add_argument('--clip-seconds', type=int, default=30,
+                        help='Length of each synthetic trailer. Defaults to 30.')
+    parser.add_argument('--resolution', choices=['480', '720', '1080'], default='720',
+                        help='Resolution of the synthetic trailers. Defaults to 720.')
+    parser.add_argument('--quantity', type=int, default=3,
+                        help='Trailers per mix. Defaults to 3.')
+    parser.add_argument('--staging-dir',
+                        help='Write mixes to this RAM disk directory, as the ' +
+                        'staging_dir setting does. Defaults to writing to disk.')
+    parser.add_argument('--seed', type=int,
+                        help='Random seed for repeatable arrival times.')
+    parser.add_argument('--work-dir',
+                        help='Directory to build the library in. Reused if it ' +
+                        'already holds a library. Defaults to a temp directory ' +
+                        'that is removed afterwards.')
+
+    return parser.parse_args()
+
+
+def get_trailer_size(res):
+    # Frame size used by convert() in download.py
+    res_mapping = {'480': '848x480', '720': '1280x720', '1080': '1920x1080'}
+    return res_mapping[res]
+
+
+def create_library(work_dir, args):
+    # Render synthetic trailers with testsrc and publish them like download.py would
+    download_dir = os.path.join(work_dir, 'downloads')
+    list_file = os.path.join(work_dir, '.downloads.txt')
+    json_file = os.path.join(work_dir, '.trailers.json')
+    if os.path.exists(json_file):
+        logging.info('Reusing library in %s', work_dir)
+        return
+
+    if not os.path.exists(download_dir):
+        os.makedirs(download_dir)
+
+    size = get_trailer_size(args.resolution)
+    file_list = []
+    for i in range(args.library_size):
+        filename = u'Synthetic {}.Trailer.{}p.mov'.format(i + 1, args.resolution)
+        logging.info('Rendering %s', filename)
+        status = subprocess.call([
+            args.ffmpeg, '-loglevel', 'panic', '-y',
+            '-f', 'lavfi', '-i', 'testsrc=size={}:rate=24:duration={}'.format(size, args.clip_seconds),
+            '-f', 'lavfi', '-i', 'sine=frequency={}:duration={}'.format(220 + 40 * i, args.clip_seconds),
+            '-c:v', 'libx264', '-c:a', 'aac', '-r', '24',
+            os.path.join(download_dir, filename),
+        ])
+        if status != 0:
+            raise RuntimeError('ffmpeg failed to render ' + filename)
+        file_list.append(filename)
+
+    write_downloaded_files(file_list, list_file)
+    publish_library_snapshot(list_file, download_dir, json_file)
+
+
+def write_settings(work_dir, args):
+    # Write a settings file pointing mix.py at the synthetic library
+    config_path = os.path.join(work_dir, 'settings.cfg')
+    with io.open(config_path, mode='w', encoding='utf-8') as f:
+        f.write(u'[DEFAULT]\n')
+        f.write(u'ffmpeg_path={}\n'.format(args.ffmpeg))
+        f.write(u'main_dir={}\n'.format(work_dir))
+        f.write(u'download_dir=downloads\n')
+        f.write(u'list_file=.downloads.txt\n')
+        f.write(u'json_file=.trailers.json\n')
+        f.write(u'selected_file=.selected.txt\n')
+        f.write(u'output_file=Trailers.mp4\n')
+        f.write(u'quantity={}\n'.format(args.quantity))
+        f.write(u'max_trailers={}\n'.format(args.library_size))
+        f.write(u'resolution={}\n'.format(args.resolution))
+        f.write(u'output_level=error\n')
+        if args.staging_dir:
+            f.write(u'staging_dir={}\n'.format(os.path.abspath(args.staging_dir)))
+    return config_path
+
+
+def get_arrival_times(args):
+    # Offsets in seconds from the start of the run at which triggers fire
+    if args.pattern == 'poisson':
+        arrivals = []
+        offset = 0.0
+        for _ in range(args.triggers):
+            arrivals.append(offset)
+            offset += random.expovariate(args.rate)
+        return arrivals
+
+    arrivals = []
+    for burst in range(args.bursts):
+        arrivals.extend([burst * args.interval] * args.burst_size)
+    return arrivals
+
+
+def get_write_bytes():
+    # Bytes written to storage by this process and its reaped children
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                if name == 'write_bytes':
+                    return int(value)
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def get_child_cpu_seconds():
+    # User plus system CPU time of reaped children
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(values, percent):
+    # Nearest-rank percentile of a list of numbers
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class TriggerRecorder(object):
+    # Run mix.py once per trigger and record latency and overlap
+
+    def __init__(self, config_path):
+        self.command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mix.py'),
+                        '-c', config_path]
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.overlapping = 0
+        self.latencies = []
+        self.failures = 0
+
+    def fire(self):
+        # Run one mix in the calling thread
+        triggered = time.time()
+        with self.lock:
+            if self.running > 0:
+                self.overlapping += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+        with open(os.devnull, 'w') as devnull:
+            status = subprocess.call(self.command, stdout=devnull, stderr=devnull)
+        ready = time.time()
+
+        with self.lock:
+            self.running -= 1
+            if status == 0:
+                self.latencies.append(ready - triggered)
+            else:
+                self.failures += 1
+
+
+def run_triggers(recorder, arrivals):
+    # Fire each trigger at its arrival time and wait for all mixes to finish
+    threads = []
+    start = time.time()
+    for offset in arrivals:
+        delay = start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        thread = threading.Thread(target=recorder.fire)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+def report(recorder, arrivals, elapsed, cpu_seconds, write_bytes):
+    # Print a summary that can be compared between runs
+    def format_seconds(value):
+        if value is None:
+            return 'n/a'
+        return '{:.3f}s'.format(value)
+
+    print('triggers:          {}'.format(len(arrivals)))
+    print('failed mixes:      {}'.format(recorder.failures))
+    print('wall time:         {}'.format(format_seconds(elapsed)))
+    print('latency p50:       {}'.format(format_seconds(percentile(recorder.latencies, 50))))
+    print('latency p95:       {}'.format(format_seconds(percentile(recorder.latencies, 95))))
+    print('latency p99:       {}'.format(format_seconds(percentile(recorder.latencies, 99))))
+    print('latency max:       {}'.format(format_seconds(max(recorder.latencies) if recorder.latencies else None)))
+    print('overlapping runs:  {}'.format(recorder.overlapping))
+    print('max concurrent:    {}'.format(recorder.max_running))
+    print('cpu time:          {}'.format(format_seconds(cpu_seconds)))
+    if write_bytes is None:
+        print('disk bytes written: n/a')
+    else:
+        print('disk bytes written: {}'.format(write_bytes))
+
+
+def main():
+    # Main script
+
+    configure_logging('downloads')
+    args = get_command_line_arguments()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    work_dir = args.work_dir
+    remove_work_dir = work_dir is None
+    if remove_work_dir:
+        work_dir = tempfile.mkdtemp(prefix='trailers-loadtest-')
+    work_dir = os.path.abspath(work_dir)
+
+    try:
+        create_library(work_dir, args)
+        config_path = write_settings(work_dir, args)
+        recorder = TriggerRecorder(config_path)
+        arrivals = get_arrival_times(args)
+
+        cpu_before = get_child_cpu_seconds()
+        write_before = get_write_bytes()
+        elapsed = run_triggers(recorder, arrivals)
+        cpu_after = get_child_cpu_seconds()
+        write_after = get_write_bytes()
+
+        cpu_seconds = None
+        if cpu_before is not None:
+            cpu_seconds = cpu_after - cpu_before
+        write_bytes = None
+        if write_before is not None:
+            write_bytes = write_after - write_before
+
+        report(recorder, arrivals, elapsed, cpu_seconds, write_bytes)
+    finally:
+        if remove_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# Run the script
+if __name__ == '__main__':
+    main()
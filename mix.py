@@ -29,16 +29,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
 import random
 import logging
 import os
 import os.path
+import shutil
+import sys
+import time
 from shared import validate_settings
 from shared import get_config_values
 from shared import get_settings
 from shared import get_command_line_arguments
 from shared import configure_logging
+from shared import acquire_library_lease
+from shared import release_library_lease
+from shared import replace_file
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where mixes are always written to disk
+    fcntl = None
 
 try:
     # For Python 3.0 and later
@@ -52,8 +63,190 @@ except ImportError:
     from ConfigParser import MissingSectionHeaderError
 
 
+# Reservations older than this are left over from a crashed mix
+STALE_RESERVATION = 60 * 60
+
+
+def prewarm_file(path):
+    # Ask the kernel to read a file into the page cache ahead of playback
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError as ex:
+        logging.debug("*** Could not prewarm %s: %s", path, ex)
+
+
+def get_staged_mixes(staging_dir, output_file):
+    # Return finished mixes in the staging directory, oldest first
+    # Mixes still being written start with a dot and are not included
+    output_root, output_ext = os.path.splitext(os.path.basename(output_file))
+    mixes = []
+    for name in os.listdir(staging_dir):
+        if name.startswith(output_root + '.') and name.endswith(output_ext):
+            path = os.path.join(staging_dir, name)
+            try:
+                mixes.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+    return [path for _, path in sorted(mixes)]
+
+
+def get_published_mix(output_file):
+    # Return the staged mix the output file links to, if any
+    if os.path.islink(output_file):
+        return os.path.realpath(output_file)
+    return None
+
+
+def lock_staging_dir(staging_dir):
+    # Take the staging directory lock. Closing the returned file releases it.
+    lock_file = open(os.path.join(staging_dir, '.lock'), 'a')
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    return lock_file
+
+
+def get_reservation_path(staging_dir, output_file):
+    # Sparse file whose size is the space this run has claimed for its mix
+    output_root, _ = os.path.splitext(os.path.basename(output_file))
+    return os.path.join(staging_dir, ".{}.{}.reserve".format(output_root, os.getpid()))
+
+
+def get_reserved_bytes(staging_dir, output_file):
+    # Space claimed by running mixes. Mixes being written are covered by
+    # their reservation. Reservations left by crashed mixes are removed
+    # along with their partial mix.
+    reserved = 0
+    now = time.time()
+    for name in os.listdir(staging_dir):
+        if not name.endswith('.reserve'):
+            continue
+        path = os.path.join(staging_dir, name)
+        try:
+            if now - os.path.getmtime(path) > STALE_RESERVATION:
+                partial_path = path[:-len('.reserve')] + os.path.splitext(output_file)[1]
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+                os.remove(path)
+                continue
+            reserved += os.path.getsize(path)
+        except OSError:
+            continue
+    return reserved
+
+
+def get_staging_usage(staging_dir, output_file):
+    # Bytes used by finished mixes plus the space reserved by running mixes
+    used = sum(os.path.getsize(path) for path in get_staged_mixes(staging_dir, output_file))
+    return used + get_reserved_bytes(staging_dir, output_file)
+
+
+def evict_staged_mixes(staging_dir, output_file, budget, needed=0):
+    # Delete old mixes, oldest first, until needed bytes fit in the budget
+    # Call with the staging directory locked. The published mix is never
+    # evicted. Plex keeps reading a mix it has already opened, since the
+    # memory is only freed once it is closed.
+    published = get_published_mix(output_file)
+    used = get_staging_usage(staging_dir, output_file)
+    for path in get_staged_mixes(staging_dir, output_file):
+        if used + needed <= budget:
+            break
+        if os.path.realpath(path) == published:
+            continue
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            used -= size
+            logging.debug("  Evicted staged mix %s", path)
+        except OSError:
+            continue
+    return used + needed <= budget
+
+
+def reserve_staging(settings, input_video):
+    # Claim room for a mix of the selected trailers in the staging directory
+    # Returns the reservation path, or None if the mix should go to disk
+    staging_dir = settings['staging_dir']
+    if not staging_dir or fcntl is None or not hasattr(os, 'symlink'):
+        return None
+
+    # A RAM disk directory is gone after a reboot, so create it as needed
+    try:
+        os.makedirs(staging_dir)
+    except OSError:
+        if not os.path.isdir(staging_dir):
+            logging.error("Could not create staging directory %s, writing to disk", staging_dir)
+            return None
+
+    needed = sum(os.path.getsize(path) for path in input_video)
+    budget = int(settings['staging_budget']) * 1024 * 1024
+    lock_file = lock_staging_dir(staging_dir)
+    try:
+        if not evict_staged_mixes(staging_dir, settings['output_file'], budget, needed):
+            logging.debug("  Mix does not fit in the staging budget, writing to disk")
+            return None
+
+        # Reservations are sparse, so the space they claim is still free
+        stats = os.statvfs(staging_dir)
+        reserved = get_reserved_bytes(staging_dir, settings['output_file'])
+        if stats.f_bavail * stats.f_frsize < needed + reserved:
+            logging.debug("  Staging directory is full, writing to disk")
+            return None
+
+        reservation_path = get_reservation_path(staging_dir, settings['output_file'])
+        with open(reservation_path, 'w') as f:
+            f.truncate(needed)
+        return reservation_path
+    finally:
+        lock_file.close()
+
+
+def release_staging(reservation_path, temp_output):
+    # Give back a reservation after a failed mix
+    for path in (temp_output, reservation_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def publish_staged_mix(temp_output, output_file, staging_dir, reservation_path):
+    # Give the staged mix its final name, atomically point the output file
+    # at it and evict the mixes it replaces
+    # Returns False, with the mix back at temp_output, if it could not be linked
+    output_root, output_ext = os.path.splitext(os.path.basename(output_file))
+    staged_path = os.path.join(staging_dir, "{}.{}.{}{}".format(
+        output_root, int(time.time() * 1000), os.getpid(), output_ext))
+    link_path = "{}.{}.lnk".format(output_file, os.getpid())
+
+    lock_file = lock_staging_dir(staging_dir)
+    try:
+        try:
+            os.rename(temp_output, staged_path)
+            os.symlink(staged_path, link_path)
+            replace_file(link_path, output_file)
+        except OSError as ex:
+            logging.error("Could not link to the staged mix, writing to disk: %s", ex)
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+            if os.path.exists(staged_path):
+                os.rename(staged_path, temp_output)
+            return False
+
+        os.remove(reservation_path)
+
+        # Only the published mix is needed from now on
+        evict_staged_mixes(staging_dir, output_file, 0)
+        return True
+    finally:
+        lock_file.close()
+
+
 def main():
     # Main script
+    # Returns 1 on failure so callers such as Tautulli see the error
 
     # Set default log level so we can log messages generated while loading the settings.
     configure_logging('')
@@ -63,10 +256,10 @@ def main():
     except MissingSectionHeaderError:
         logging.error('Configuration file is missing a header section, ' +
                       'try adding [DEFAULT] at the top of the file')
-        return
+        return 1
     except (Error, ValueError) as ex:
         logging.error("Configuration error: %s", ex)
-        return
+        return 1
 
     configure_logging(settings['output_level'])
 
@@ -78,30 +271,79 @@ def main():
 
     logging.debug("")
 
-    # Get downloaded trailers
-    trailers = json.load(open(settings['json_file']))
+    # Pin the current library generation so download.py cannot delete its files
+    try:
+        lease_path, trailers = acquire_library_lease(settings['json_file'])
+    except (IOError, OSError, ValueError) as ex:
+        logging.error("Could not load trailer library: %s", ex)
+        return 1
+
+    try:
+        # Randomly select trailers
+        quantity = min(int(settings['quantity']), len(trailers))
+        input_video = random.sample(trailers, quantity)
+        if not input_video:
+            logging.error("No trailers have been downloaded yet")
+            return 1
+
+        # Set selected trailers in a temp file private to this run
+        selected_file = "{}.{}".format(settings['selected_file'], os.getpid())
+        with open(selected_file, "w") as f:
+            for i in input_video:
+                item = i.replace("'", "\\'")
+                f.write('file \'' + item + '\'' + os.linesep)
 
-    # Randomly select trailers
-    selected_trailers = random.sample(range(1,int(settings['max_trailers'])+1),int(settings['quantity']))
+        if settings['prewarm'] == 'yes':
+            for path in input_video:
+                prewarm_file(path)
 
-    input_video = []
+        # Convert selected trailers into one video, either in the staging
+        # directory or next to the output file, and swap it into place so
+        # Plex never opens a half-written file
+        reservation_path = reserve_staging(settings, input_video)
+        staged = reservation_path is not None
+        if staged:
+            output_root, output_ext = os.path.splitext(os.path.basename(settings['output_file']))
+            temp_output = os.path.join(settings['staging_dir'], ".{}.{}{}".format(output_root, os.getpid(), output_ext))
+        else:
+            output_root, output_ext = os.path.splitext(settings['output_file'])
+            temp_output = "{}.{}{}".format(output_root, os.getpid(), output_ext)
+        status = os.system(settings['ffmpeg_path']+' -loglevel panic -y -f concat -safe 0 -i '+selected_file+' -c copy '+temp_output)
 
-    for x in selected_trailers:
-        input_video.append(trailers[str(x)])
+        # Remove temp file
+        os.remove(selected_file)
 
-    # Set selected trailers in temp file
-    with open(settings['selected_file'], "w") as f:
-        for i in input_video:
-            item = i.replace("'", "\\'")
-            f.write('file \'' + item + '\'' + os.linesep)
-    f.close
+        if status != 0 or not os.path.exists(temp_output):
+            logging.error("ffmpeg failed to mix trailers")
+            if staged:
+                release_staging(reservation_path, temp_output)
+            elif os.path.exists(temp_output):
+                os.remove(temp_output)
+            return 1
 
-    # Convert selected trailers into one video
-    os.system(settings['ffmpeg_path']+' -loglevel panic -y -f concat -safe 0 -i '+settings['selected_file']+' -c copy '+settings['output_file'])
+        if staged and not publish_staged_mix(temp_output, settings['output_file'], settings['staging_dir'], reservation_path):
+            # Copy the mix next to the output file and give back its staging space
+            output_root, output_ext = os.path.splitext(settings['output_file'])
+            disk_output = "{}.{}{}".format(output_root, os.getpid(), output_ext)
+            shutil.copyfile(temp_output, disk_output)
+            release_staging(reservation_path, temp_output)
+            temp_output = disk_output
+            staged = False
 
-    # Remove temp file
-    os.remove(settings['selected_file'])
+        if not staged:
+            replace_file(temp_output, settings['output_file'])
+            if settings['prewarm'] == 'yes':
+                prewarm_file(settings['output_file'])
+            if settings['staging_dir'] and fcntl is not None:
+                # The output file no longer links to any staged mix
+                lock_file = lock_staging_dir(settings['staging_dir'])
+                try:
+                    evict_staged_mixes(settings['staging_dir'], settings['output_file'], 0)
+                finally:
+                    lock_file.close()
+    finally:
+        release_library_lease(lease_path)
 
 # Run the script
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+
+# Schedules the work done by download.py so that it only uses resources
+# that Plex is not using.
+#
+# Encodes are queued and started from a background thread. Before each
+# start the host load is sampled and the number of concurrent encodes and
+# ffmpeg threads is sized to the spare CPU. While the host is busy or Plex
+# is transcoding, queued encodes wait. Encodes run at a low nice level and
+# idle IO priority where supported.
+#
+# Downloads share one token bucket whose rate follows a time-of-day
+# schedule, and only run inside the allowed download hours.
+
+# Copyright 2018 David Engel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import subprocess
+import threading
+import time
+from shared import parse_rate_schedule
+from shared import parse_time_ranges
+
+try:
+    # For Python 3.0 and later
+    from urllib.request import urlopen
+    from urllib.request import Request
+except ImportError:
+    # Fall back for Python 2.7
+    from urllib2 import urlopen
+    from urllib2 import Request
+
+
+# Seconds between load samples while encodes are queued or running.
+# Encodes that exit wake the scheduler early where os.waitid exists.
+POLL_INTERVAL = 5
+
+# Seconds of traffic a download may burst above the rate limit
+BURST_SECONDS = 1
+
+
+def find_executable(name):
+    # Return the full path of an executable on the PATH, or None
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def read_cpu_times():
+    # Return (busy, total) jiffies for all CPUs from /proc/stat, or None
+    try:
+        with open('/proc/stat') as f:
+            fields = f.readline().split()
+    except (IOError, OSError):
+        return None
+    values = [int(value) for value in fields[1:]]
+    # user nice system idle iowait irq softirq steal ...
+    idle = values[3] + values[4]
+    total = sum(values[:8])
+    return total - idle, total
+
+
+def read_process_cpu_time(pid):
+    # Return utime + stime jiffies of a process from /proc, or 0
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return 0
+    # The command name may contain spaces, so split after its closing paren
+    fields = stat[stat.rindex(')') + 2:].split()
+    return int(fields[11]) + int(fields[12])
+
+
+def count_plex_transcodes(sessions_url):
+    # Count transcode sessions reported by Plex's /status/sessions endpoint
+    req = Request(sessions_url, None, {'Accept': 'application/json'})
+    try:
+        response = urlopen(req, timeout=5)
+        sessions = json.loads(response.read().decode('utf-8'))
+    except Exception as ex:
+        logging.debug("*** Could not read Plex sessions: %s", ex)
+        return 0
+    container = sessions.get('MediaContainer', {})
+    return len([item for item in container.get('Metadata', []) if 'TranscodeSession' in item])
+
+
+class HostLoad(object):
+    # Measures how much CPU is in use by everything except our own encodes
+
+    def __init__(self, cpu_count, sessions_url=''):
+        self.cpu_count = cpu_count
+        self.sessions_url = sessions_url
+        self.last_times = read_cpu_times()
+        # Latest CPU time read for each encode, and how much of it has
+        # already been subtracted from a sample
+        self.own_seen = {}
+        self.own_counted = {}
+        self.finished = set()
+
+    def track(self, pid):
+        # Read an encode's CPU time. Call before it is reaped so the time
+        # from its last moments is not lost.
+        cpu_time = read_process_cpu_time(pid)
+        self.own_seen[pid] = max(cpu_time, self.own_seen.get(pid, 0))
+
+    def finish(self, pid):
+        # Count an encode's final CPU time in the next sample, then forget it
+        self.finished.add(pid)
+
+    def sample(self, own_threads):
+        # Return (fraction of CPU used by others, number of Plex transcodes)
+        for pid in self.own_seen:
+            if pid not in self.finished:
+                self.track(pid)
+        own = sum(self.own_seen[pid] - self.own_counted.get(pid, 0) for pid in self.own_seen)
+        self.own_counted = dict(self.own_seen)
+        for pid in self.finished:
+            self.own_seen.pop(pid, None)
+            self.own_counted.pop(pid, None)
+        self.finished = set()
+
+        times = read_cpu_times()
+        if times is not None and self.last_times is not None:
+            busy = times[0] - self.last_times[0]
+            total = times[1] - self.last_times[1]
+            self.last_times = times
+            if total <= 0:
+                other = 0.0
+            else:
+                other = float(max(busy - own, 0)) / total
+        elif hasattr(os, 'getloadavg'):
+            # No /proc, so estimate from the load average
+            load = os.getloadavg()[0] - own_threads
+            other = max(load, 0) / float(self.cpu_count)
+        else:
+            other = 0.0
+
+        transcodes = 0
+        if self.sessions_url:
+            transcodes = count_plex_transcodes(self.sessions_url)
+        return min(other, 1.0), transcodes
+
+
+class EncodeJob(object):
+    # One queued ffmpeg run
+
+    def __init__(self, args, output_path, on_success=None, on_failure=None):
+        # args is the ffmpeg command line without the executable, -threads
+        # or the output file
+        self.args = args
+        self.output_path = output_path
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.process = None
+        self.threads = 0
+
+
+class EncodeScheduler(object):
+    # Runs queued encodes on spare CPU in a background thread
+
+    def __init__(self, ffmpeg_path, max_encodes=1, cpu_limit=0.75, nice=10, sessions_url='',
+                 cpu_count=None, host_load=None, max_hold=0):
+        self.ffmpeg_path = ffmpeg_path
+        self.max_encodes = max(int(max_encodes), 1)
+        self.cpu_limit = float(cpu_limit)
+        self.nice = int(nice)
+        # Seconds queued encodes may be held before they are left for the
+        # next run, 0 to wait as long as it takes
+        self.max_hold = max_hold
+        self.cpu_count = cpu_count or multiprocessing.cpu_count()
+        self.host_load = host_load or HostLoad(self.cpu_count, sessions_url)
+        self.nice_path = None
+        self.ionice_path = None
+        if self.nice > 0:
+            self.nice_path = find_executable('nice')
+            self.ionice_path = find_executable('ionice')
+        self.queue = []
+        self.running = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.paused_since = None
+        self.gave_up = False
+
+    def submit(self, job):
+        # Queue an encode and make sure the scheduler thread is running
+        with self.lock:
+            if self.gave_up:
+                logging.debug("  Encodes were held too long, leaving this one for the next run")
+                return
+            self.queue.append(job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        self.wakeup.set()
+
+    def wait(self):
+        # Block until every queued encode has finished
+        with self.lock:
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def run(self):
+        # Scheduler loop, exits once the queue is empty and nothing is running
+        try:
+            while True:
+                self.reap()
+                with self.lock:
+                    if not self.queue and not self.running:
+                        return
+                self.wakeup.clear()
+                self.start_jobs()
+                self.wakeup.wait(POLL_INTERVAL)
+        except Exception:
+            logging.exception("*** Encode scheduler stopped")
+        finally:
+            # Let the next submit start a new thread
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+
+    def reap(self):
+        # Run callbacks for encodes that have finished
+        for job in list(self.running):
+            self.host_load.track(job.process.pid)
+            status = job.process.poll()
+            if status is None:
+                continue
+            self.host_load.finish(job.process.pid)
+            self.running.remove(job)
+            if status == 0:
+                self.run_callback(job.on_success)
+            else:
+                logging.error("*** Encode failed with exit code %s", status)
+                self.run_callback(job.on_failure)
+
+    def run_callback(self, callback):
+        # Run a job callback without letting its errors stop the scheduler
+        if not callback:
+            return
+        try:
+            callback()
+        except Exception as ex:
+            logging.error("*** Error finishing encode: %s", ex)
+
+    def plan(self, other_load, transcodes):
+        # Return (encodes allowed to run, threads for each new encode)
+        if transcodes > 0 or other_load >= self.cpu_limit:
+            return 0, 0
+        spare_cpus = max(int((self.cpu_limit - other_load) * self.cpu_count), 1)
+        slots = min(self.max_encodes, spare_cpus)
+        return slots, max(spare_cpus // slots, 1)
+
+    def start_jobs(self):
+        # Start as many queued encodes as the spare CPU allows
+        own_threads = sum(job.threads for job in self.running)
+        other_load, transcodes = self.host_load.sample(own_threads)
+        slots, threads = self.plan(other_load, transcodes)
+
+        with self.lock:
+            waiting = len(self.queue)
+        if slots == 0:
+            if not waiting:
+                return
+            now = time.time()
+            if self.paused_since is None:
+                logging.debug("  Holding %s encode(s): host load %.0f%%, %s Plex transcode(s)",
+                              waiting, other_load * 100, transcodes)
+                self.paused_since = now
+            elif self.max_hold and now - self.paused_since > self.max_hold:
+                # Downloaded files stay as .part files and are converted next run
+                logging.info("*** Host busy for too long, leaving %s encode(s) for the next run", waiting)
+                with self.lock:
+                    self.queue = []
+                    self.gave_up = True
+            return
+        if self.paused_since is not None and waiting:
+            logging.debug("  Resuming encodes with %s thread(s) each", threads)
+        self.paused_since = None
+
+        while len(self.running) < slots:
+            with self.lock:
+                if not self.queue:
+                    return
+                job = self.queue.pop(0)
+            try:
+                self.start(job, threads)
+            except OSError as ex:
+                logging.error("*** Could not start encode: %s", ex)
+                self.run_callback(job.on_failure)
+
+    def start(self, job, threads):
+        # Launch ffmpeg for a job at low priority
+        command = [self.ffmpeg_path] + job.args + ['-threads', str(threads), job.output_path]
+        if self.nice_path:
+            command = [self.nice_path, '-n', str(self.nice)] + command
+        if self.ionice_path:
+            command = [self.ionice_path, '-c', '3'] + command
+
+        job.threads = threads
+        job.process = subprocess.Popen(command)
+        self.host_load.track(job.process.pid)
+        self.running.append(job)
+
+        if hasattr(os, 'waitid'):
+            watcher = threading.Thread(target=self.watch, args=(job.process.pid,))
+            watcher.daemon = True
+            watcher.start()
+
+    def watch(self, pid):
+        # Wake the scheduler as soon as an encode exits. WNOWAIT leaves the
+        # process for reap() so its final CPU time can still be read.
+        try:
+            os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        except OSError:
+            pass
+        self.wakeup.set()
+
+
+def in_time_range(minute, start, end):
+    # Check if a minute of the day falls inside a range that may wrap midnight
+    if start == end:
+        return True
+    if start < end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+def get_minute_of_day(now=None):
+    # Minutes past local midnight
+    local = time.localtime(now)
+    return local.tm_hour * 60 + local.tm_min
+
+
+class BandwidthLimiter(object):
+    # Token bucket shared by every download, with time-of-day rates and
+    # an allowed download window
+
+    def __init__(self, rate_schedule='', download_hours=''):
+        self.schedule = parse_rate_schedule(rate_schedule)
+        self.windows = parse_time_ranges(download_hours)
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.last_refill = time.time()
+
+    def in_window(self, now=None):
+        # Check if downloads are allowed right now
+        if not self.windows:
+            return True
+        minute = get_minute_of_day(now)
+        return any(in_time_range(minute, start, end) for start, end in self.windows)
+
+    def get_rate(self, now=None):
+        # Bytes per second allowed right now, 0 for unlimited
+        minute = get_minute_of_day(now)
+        for start, end, rate in self.schedule:
+            if in_time_range(minute, start, end):
+                return rate
+        return 0
+
+    def get_chunk_size(self, chunk_size):
+        # Read size that keeps sleeps short at the current rate
+        rate = self.get_rate()
+        if rate:
+            return max(min(chunk_size, rate // 4), 1)
+        return chunk_size
+
+    def consume(self, size):
+        # Take size bytes from the bucket, sleeping until they are available
+        with self.lock:
+            now = time.time()
+            rate = self.get_rate(now)
+            if not rate:
+                self.tokens = 0.0
+                self.last_refill = now
+                return
+            capacity = rate * BURST_SECONDS
+            self.tokens = min(capacity, self.tokens + (now - self.last_refill) * rate)
+            self.last_refill = now
+            self.tokens -= size
+            delay = 0
+            if self.tokens < 0:
+                delay = -self.tokens / rate
+        # Sleep outside the lock; the debt already holds back other downloads
+        if delay:
+            time.sleep(delay)
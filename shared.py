@@ -47,7 +47,7 @@ def validate_settings(settings):
     valid_video_types = ['single_trailer', 'trailers', 'all']
     valid_output_levels = ['debug', 'downloads', 'error']
 
-    required_settings = ['ffmpeg_path', 'main_dir', 'download_dir', 'list_file', 'json_file', 'selected_file', 'output_file', 'max_trailers', 'quantity', 'resolution', 'video_types', 'output_level']
+    required_settings = ['ffmpeg_path', 'main_dir', 'download_dir', 'list_file', 'json_file', 'selected_file', 'output_file', 'max_trailers', 'quantity', 'resolution', 'video_types', 'output_level', 'max_encodes', 'encode_cpu_limit', 'encode_nice', 'encode_max_hold', 'plex_sessions_url', 'download_rate_limit', 'download_hours', 'staging_dir', 'staging_budget', 'prewarm']
 
     for setting in required_settings:
         if setting not in settings:
@@ -83,9 +83,89 @@ def validate_settings(settings):
         output_string = ', '.join(valid_output_levels)
         raise ValueError("invalid output level. Valid values: {}".format(output_string))
 
+    try:
+        if int(settings['max_encodes']) < 1:
+            raise ValueError
+    except ValueError:
+        raise ValueError('max encodes must be a whole number of at least 1')
+
+    try:
+        if not 0 < float(settings['encode_cpu_limit']) <= 1:
+            raise ValueError
+    except ValueError:
+        raise ValueError('the encode cpu limit must be a number between 0 and 1')
+
+    try:
+        if not 0 <= int(settings['encode_nice']) <= 19:
+            raise ValueError
+    except ValueError:
+        raise ValueError('the encode nice level must be a whole number from 0 to 19')
+
+    try:
+        if int(settings['encode_max_hold']) < 0:
+            raise ValueError
+    except ValueError:
+        raise ValueError('the encode max hold must be a whole number of minutes')
+
+    parse_rate_schedule(settings['download_rate_limit'])
+    parse_time_ranges(settings['download_hours'])
+
+    try:
+        if int(settings['staging_budget']) < 1:
+            raise ValueError
+    except ValueError:
+        raise ValueError('the staging budget must be a whole number of MB')
+
+    if settings['prewarm'].lower() not in ['yes', 'no']:
+        raise ValueError("invalid prewarm value. Valid values: yes, no")
+
     return True
 
 
+def parse_time_range(text):
+    # Parse "HH:MM-HH:MM" into (start, end) minutes past midnight
+    try:
+        start, end = text.strip().split('-')
+        minutes = []
+        for value in (start, end):
+            hours, mins = value.strip().split(':')
+            hours, mins = int(hours), int(mins)
+            if not (0 <= hours <= 24 and 0 <= mins < 60) or hours * 60 + mins > 24 * 60:
+                raise ValueError
+            minutes.append(hours * 60 + mins)
+    except ValueError:
+        raise ValueError("invalid time range '{}', expected HH:MM-HH:MM".format(text.strip()))
+    return minutes[0], minutes[1]
+
+
+def parse_time_ranges(text):
+    # Parse comma separated time ranges. Empty means the whole day.
+    return [parse_time_range(item) for item in text.split(',') if item.strip()]
+
+
+def parse_rate_schedule(text):
+    # Parse a rate limit in KB/s, either a single number or comma separated
+    # "HH:MM-HH:MM=rate" entries, into a list of (start, end, bytes per second)
+    schedule = []
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            time_range, rate = item.split('=', 1)
+            start, end = parse_time_range(time_range)
+        else:
+            start, end, rate = 0, 24 * 60, item
+        try:
+            kb_per_second = float(rate)
+            if kb_per_second < 0:
+                raise ValueError
+        except ValueError:
+            raise ValueError("invalid download rate '{}', expected KB/s".format(rate.strip()))
+        schedule.append((start, end, int(kb_per_second * 1024)))
+    return schedule
+
+
 def get_config_values(config_path, defaults):
     # Get settings from config file
 
@@ -134,6 +214,16 @@ def get_settings():
         'resolution': '720',
         'video_types': 'single_trailer',
         'output_level': 'debug',
+        'max_encodes': 1,
+        'encode_cpu_limit': 0.75,
+        'encode_nice': 10,
+        'encode_max_hold': 120,
+        'plex_sessions_url': '',
+        'download_rate_limit': '',
+        'download_hours': '',
+        'staging_dir': '',
+        'staging_budget': 2048,
+        'prewarm': 'yes',
     }
 
     args = get_command_line_arguments()
@@ -163,6 +253,8 @@ def get_settings():
         )
 
     settings['list_file'] = os.path.expanduser(settings['list_file'])
+    settings['staging_dir'] = os.path.expanduser(settings['staging_dir'])
+    settings['prewarm'] = settings['prewarm'].lower()
 
     validate_settings(settings)
 
@@ -270,3 +362,114 @@ def configure_logging(output_level):
 
     logging.basicConfig(format='%(message)s')
     logging.getLogger().setLevel(log_level)
+
+
+# Leases older than this are left over from a crashed mix and are ignored
+LEASE_TIMEOUT = 6 * 60 * 60
+
+
+def replace_file(src_path, dest_path):
+    # Atomically move a file over another one
+    if hasattr(os, 'replace'):
+        os.replace(src_path, dest_path)
+    else:
+        # Python 2.7 has no os.replace. rename is atomic on POSIX but
+        # refuses to overwrite on Windows.
+        if os.name == 'nt' and os.path.exists(dest_path):
+            os.remove(dest_path)
+        os.rename(src_path, dest_path)
+
+
+def write_json_atomically(data, path):
+    # Write json to a temp file and swap it into place so readers never see a partial file
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    replace_file(temp_path, path)
+
+
+def get_snapshot_path(json_file, generation):
+    # Path of the immutable library snapshot for a generation
+    return "{}.{}".format(json_file, generation)
+
+
+def get_lease_dir(json_file):
+    # Directory holding one lease file per running mix
+    return json_file + '.readers'
+
+
+def load_library_pointer(json_file):
+    # Return the current generation and its snapshot path
+    # A json file written before snapshots existed is treated as generation 0
+    with open(json_file) as f:
+        pointer = json.load(f)
+    if 'snapshot' not in pointer:
+        return 0, json_file
+    return int(pointer['generation']), pointer['snapshot']
+
+
+def load_library_snapshot(snapshot_path):
+    # Return the list of trailer paths in a snapshot
+    with open(snapshot_path) as f:
+        snapshot = json.load(f)
+    if 'trailers' in snapshot:
+        return snapshot['trailers']
+    # Old format: {"1": path, "2": path, ...}
+    return [snapshot[key] for key in sorted(snapshot, key=int)]
+
+
+def acquire_library_lease(json_file):
+    # Pin the current library generation so download.py will not delete its files
+    # The lease is created empty first, which pins every generation, so there
+    # is no window between reading the pointer and registering the lease.
+    lease_dir = get_lease_dir(json_file)
+    try:
+        os.makedirs(lease_dir)
+    except OSError:
+        if not os.path.isdir(lease_dir):
+            raise
+    lease_path = os.path.join(lease_dir, str(os.getpid()))
+    open(lease_path, 'w').close()
+
+    try:
+        generation, snapshot_path = load_library_pointer(json_file)
+        with open(lease_path, 'w') as f:
+            f.write(str(generation))
+        return lease_path, load_library_snapshot(snapshot_path)
+    except:
+        release_library_lease(lease_path)
+        raise
+
+
+def release_library_lease(lease_path):
+    # Remove a lease taken by acquire_library_lease
+    try:
+        os.remove(lease_path)
+    except (IOError, OSError):
+        pass
+
+
+def get_leased_generations(json_file, now):
+    # Return the set of generations pinned by running mixes, or None if
+    # a lease is still being written and every generation must be kept
+    lease_dir = get_lease_dir(json_file)
+    generations = set()
+    if not os.path.isdir(lease_dir):
+        return generations
+    for name in os.listdir(lease_dir):
+        lease_path = os.path.join(lease_dir, name)
+        try:
+            if now - os.path.getmtime(lease_path) > LEASE_TIMEOUT:
+                logging.debug("*** Removing stale lease " + lease_path)
+                os.remove(lease_path)
+                continue
+            with open(lease_path) as f:
+                generations.add(int(f.read().strip()))
+        except (IOError, OSError):
+            # The mix finished while we were looking
+            continue
+        except ValueError:
+            return None
+    return generations